@@ -251,6 +251,10 @@ EMAIL_HOST = os.getenv("MAILGUN_SMTP_SERVER", "")
 EMAIL_PORT = int(os.getenv("MAILGUN_SMTP_PORT", "587"))
 EMAIL_USE_TLS = True
 
+# Bound each SMTP call. Webhook emails go out after commit but still inside the request,
+# so a slow mail server delays Stripe's response by at most this (per attempt).
+EMAIL_TIMEOUT = int(os.getenv("EMAIL_TIMEOUT", "10"))
+
 EMAIL_HOST_USER = os.getenv("MAILGUN_SMTP_LOGIN", "")
 EMAIL_HOST_PASSWORD = os.getenv("MAILGUN_SMTP_PASSWORD", "")
 
@@ -269,6 +273,7 @@ DEFAULT_REPLY_TO_EMAIL = os.getenv(
 # -------------------------
 STRIPE_SECRET_KEY = os.getenv("STRIPE_SECRET_KEY", "")
 STRIPE_PUBLISHABLE_KEY = os.getenv("STRIPE_PUBLISHABLE_KEY", "")
+# Comma-separated to accept several signing secrets (e.g. while rolling the endpoint secret)
 STRIPE_WEBHOOK_SECRET = os.getenv("STRIPE_WEBHOOK_SECRET", "")
 
 STRIPE_PRICE_BASIC = os.getenv("STRIPE_PRICE_BASIC", "")
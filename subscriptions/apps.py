@@ -1,6 +1,21 @@
 from django.apps import AppConfig
+from django.conf import settings
 
 
 class SubscriptionsConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'subscriptions'
+
+    def ready(self):
+        # Register signals
+        from . import signals  # noqa: F401
+
+        # Configure the Stripe SDK once at startup (management commands may run without keys)
+        if getattr(settings, "STRIPE_SECRET_KEY", ""):
+            from .stripe_service import init_stripe
+            init_stripe()
+
+        # Pay template compilation at boot rather than on a worker's first webhook.
+        # Plan lookups stay lazy: querying here would run before migrations/test DB setup.
+        from .sync import warm_email_templates
+        warm_email_templates()
@@ -0,0 +1,18 @@
+# Generated by Django 5.2.8 on 2026-10-16 10:00
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('subscriptions', '0005_pmbsubscription'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='subscription',
+            name='stripe_subscription_id',
+            field=models.CharField(blank=True, db_index=True, max_length=120),
+        ),
+    ]
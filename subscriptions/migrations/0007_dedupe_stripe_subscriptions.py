@@ -0,0 +1,38 @@
+from django.db import migrations
+from django.db.models import Count, Min
+
+
+def dedupe_stripe_subscriptions(apps, schema_editor):
+    """
+    Collapse duplicate (profile, stripe_subscription_id) rows before the unique constraint
+    in 0008 goes on. The checkout webhook and checkout_success could both insert the same
+    new subscription; keep the most recently updated row (the latest Stripe state) and
+    carry over the earliest started_at from its duplicates.
+    """
+    Subscription = apps.get_model("subscriptions", "Subscription")
+    dupes = (
+        Subscription.objects.exclude(stripe_subscription_id="")
+        .values("profile_id", "stripe_subscription_id")
+        .annotate(rows=Count("id"), first_started_at=Min("started_at"))
+        .filter(rows__gt=1)
+    )
+    for dupe in dupes:
+        rows = Subscription.objects.filter(
+            profile_id=dupe["profile_id"],
+            stripe_subscription_id=dupe["stripe_subscription_id"],
+        ).order_by("-updated_at", "-id")
+        keep = rows[0]
+        rows.exclude(pk=keep.pk).delete()
+        if dupe["first_started_at"] and keep.started_at != dupe["first_started_at"]:
+            Subscription.objects.filter(pk=keep.pk).update(started_at=dupe["first_started_at"])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('subscriptions', '0006_alter_subscription_stripe_subscription_id'),
+    ]
+
+    operations = [
+        migrations.RunPython(dedupe_stripe_subscriptions, migrations.RunPython.noop),
+    ]
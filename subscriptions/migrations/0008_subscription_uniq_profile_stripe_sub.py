@@ -0,0 +1,17 @@
+# Generated by Django 5.2.8 on 2026-10-16 10:30
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('subscriptions', '0007_dedupe_stripe_subscriptions'),
+    ]
+
+    operations = [
+        migrations.AddConstraint(
+            model_name='subscription',
+            constraint=models.UniqueConstraint(condition=models.Q(('stripe_subscription_id', ''), _negated=True), fields=('profile', 'stripe_subscription_id'), name='uniq_profile_stripe_sub'),
+        ),
+    ]
@@ -0,0 +1,17 @@
+# Generated by Django 5.2.8 on 2026-10-16 11:05
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('subscriptions', '0009_stripewebhookevent'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='subscription',
+            index=models.Index(fields=['profile', 'plan', 'status'], name='sub_trial_lookup_idx'),
+        ),
+    ]
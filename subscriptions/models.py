@@ -90,7 +90,8 @@ class Subscription(models.Model):
     )
 
     stripe_customer_id = models.CharField(max_length=120, blank=True)
-    stripe_subscription_id = models.CharField(max_length=120, blank=True)
+    # Indexed: webhooks look subscriptions up by Stripe id alone
+    stripe_subscription_id = models.CharField(max_length=120, blank=True, db_index=True)
 
     cancel_at_period_end = models.BooleanField(default=False)
 
@@ -114,6 +115,18 @@ class Subscription(models.Model):
 
     class Meta:
         ordering = ["-created_at"]
+        constraints = [
+            # One row per Stripe subscription; local trial rows have no Stripe id and are exempt
+            models.UniqueConstraint(
+                fields=["profile", "stripe_subscription_id"],
+                condition=~models.Q(stripe_subscription_id=""),
+                name="uniq_profile_stripe_sub",
+            ),
+        ]
+        indexes = [
+            # Trial sweep on upgrade: filter(profile, plan=<trial>, status=trialing)
+            models.Index(fields=["profile", "plan", "status"], name="sub_trial_lookup_idx"),
+        ]
 
     def save(self, *args, **kwargs):
         # Auto-populate started_at the first time a subscription becomes active/trialing
@@ -198,3 +211,16 @@ class PmbSubscription(models.Model):
 
     def __str__(self) -> str:
         return f"PMB {self.principal_id} ({self.tier})"
+
+
+class StripeWebhookEvent(models.Model):
+    """
+    Stripe event ids the webhook has processed, so redeliveries are skipped.
+    Written in the same transaction as the event's changes.
+    """
+
+    event_id = models.CharField(max_length=255, primary_key=True)
+    received_at = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self) -> str:
+        return self.event_id
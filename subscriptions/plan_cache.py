@@ -0,0 +1,44 @@
+# subscriptions/plan_cache.py
+import time
+
+from .models import SubscriptionPlan
+
+# Seconds a process keeps its plan snapshot. The post_save/post_delete receivers only clear
+# the cache in the process that made the edit; other workers/dynos pick it up on reload.
+PLAN_CACHE_TTL = 60
+
+# code -> SubscriptionPlan for every plan, loaded in one query and reloaded after PLAN_CACHE_TTL.
+# Rebound (never mutated) on reload, so concurrent readers always see a complete dict.
+_PLAN_CACHE = {}
+_loaded_at = None
+
+
+def _plans_by_code() -> dict:
+    global _PLAN_CACHE, _loaded_at
+    now = time.monotonic()
+    if _loaded_at is None or now - _loaded_at > PLAN_CACHE_TTL:
+        _PLAN_CACHE = SubscriptionPlan.objects.in_bulk(field_name="code")
+        _loaded_at = now
+    return _PLAN_CACHE
+
+
+def get_plan(code: str):
+    """SubscriptionPlan by code (or None), cached per process for up to PLAN_CACHE_TTL seconds."""
+    return _plans_by_code().get(code)
+
+
+def get_active_plan(code: str):
+    """Like get_plan(), but None for plans switched off in the admin (is_active=False)."""
+    plan = get_plan(code)
+    return plan if plan and plan.is_active else None
+
+
+def known_plan_codes():
+    """Codes of every SubscriptionPlan, for cheap membership checks before any other query."""
+    return _plans_by_code().keys()
+
+
+def clear_plan_cache() -> None:
+    """Force a reload on next use (this process only; others follow within PLAN_CACHE_TTL)."""
+    global _loaded_at
+    _loaded_at = None
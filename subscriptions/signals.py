@@ -0,0 +1,12 @@
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+from .models import SubscriptionPlan
+from .plan_cache import clear_plan_cache
+
+
+@receiver(post_save, sender=SubscriptionPlan)
+@receiver(post_delete, sender=SubscriptionPlan)
+def invalidate_plan_cache(sender, **kwargs):
+    # Reload plans in this process now; other processes follow within PLAN_CACHE_TTL
+    clear_plan_cache()
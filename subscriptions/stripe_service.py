@@ -6,7 +6,9 @@ from django.core.exceptions import ImproperlyConfigured
 
 def init_stripe() -> None:
     """
-    Configure Stripe SDK once per request path that needs it.
+    Configure Stripe SDK with the MintKit key.
+    Runs at startup (SubscriptionsConfig.ready) and again in views that call the API.
+    PlanMyBalance calls pass their own api_key per request and leave this untouched.
     """
     secret_key = getattr(settings, "STRIPE_SECRET_KEY", "") or ""
     if not secret_key:
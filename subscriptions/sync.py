@@ -0,0 +1,235 @@
+# subscriptions/sync.py
+# Shared by the Stripe webhooks and the checkout views: writing Stripe subscription
+# state to local rows, and sending the subscription emails.
+import copy
+import datetime
+import smtplib
+from functools import partial
+from types import MappingProxyType
+from urllib.parse import urlsplit
+
+from django.conf import settings
+from django.core.mail import EmailMultiAlternatives, get_connection
+from django.db import IntegrityError, transaction
+from django.template.loader import get_template
+
+from accounts.models import Profile
+from .models import Subscription
+
+_UTC = datetime.timezone.utc
+_EPOCH = datetime.datetime(1970, 1, 1, tzinfo=_UTC)
+
+
+def utc_from_ts(ts):
+    """Stripe timestamps are unix seconds; convert to timezone-aware UTC datetime."""
+    # Plain offset from the epoch: no local-time/DST conversion needed for UTC seconds
+    return _EPOCH + datetime.timedelta(seconds=ts) if ts else None
+
+
+STRIPE_STATUS_MAP = MappingProxyType({
+    "active": Subscription.STATUS_ACTIVE,
+    "trialing": Subscription.STATUS_TRIALING,
+    "past_due": Subscription.STATUS_PAST_DUE,
+    "unpaid": Subscription.STATUS_PAST_DUE,
+    "incomplete": Subscription.STATUS_INCOMPLETE,
+    "incomplete_expired": Subscription.STATUS_INCOMPLETE,
+    "canceled": Subscription.STATUS_CANCELED,
+    "cancelled": Subscription.STATUS_CANCELED,
+})
+
+
+def map_stripe_status(stripe_status: str) -> str:
+    """Local status for an already stripped/lowercased Stripe status."""
+    return STRIPE_STATUS_MAP.get(stripe_status, Subscription.STATUS_CANCELED)
+
+
+# Profile columns read when linking/emailing, as seen from a Subscription row
+_PROFILE_EMAIL_FIELDS = (
+    "profile__id",
+    "profile__contact_email",
+    "profile__user__email",
+    "profile__user__first_name",
+    "profile__user__username",
+)
+
+# Subscription columns callers read from an existing row (started_at is used by save())
+_SUBSCRIPTION_FIELDS = ("id", "plan", "status", "cancel_at_period_end", "cancel_at", "started_at")
+
+
+def lock_subscription(stripe_sub_id):
+    """
+    Local row for a Stripe subscription (or None), locked for the caller's transaction.
+    Profile/user and plan come back in the same query, so callers need no further lookups.
+    """
+    if not stripe_sub_id:
+        return None
+    return (
+        Subscription.objects.select_for_update(of=("self",))
+        .select_related("profile__user", "plan")
+        .only(*_SUBSCRIPTION_FIELDS, *_PROFILE_EMAIL_FIELDS, "plan__code", "plan__name")
+        .filter(stripe_subscription_id=stripe_sub_id)
+        .first()
+    )
+
+
+def upsert_subscription(
+    profile: Profile, stripe_sub_id: str, existing, defaults: dict, create_defaults: dict | None = None
+):
+    """
+    Write Stripe state for one subscription (webhooks and checkout_success).
+    Callers already load `existing` to compare previous status, so reuse it:
+    a single UPDATE of the changed columns, or a single INSERT when new.
+    `create_defaults` (as in update_or_create) are extra fields used only for the INSERT.
+
+    Returns (subscription, previous), where `previous` is a copy of the row before this
+    write (None if it was inserted); callers detect transitions against it.
+    """
+    if existing is None:
+        try:
+            # Savepoint: a failed INSERT must not break the caller's transaction
+            with transaction.atomic():
+                return (
+                    Subscription.objects.create(
+                        profile=profile,
+                        stripe_subscription_id=stripe_sub_id,
+                        **{**defaults, **(create_defaults or {})},
+                    ),
+                    None,
+                )
+        except IntegrityError:
+            # The checkout webhook and checkout_success both create a new subscription at once;
+            # select_for_update had no row to lock, so the loser lands here (uniq_profile_stripe_sub).
+            # The winner has committed by now: lock its row and apply this write as an update.
+            existing = lock_subscription(stripe_sub_id)
+            if existing is None:
+                raise
+
+    previous = copy.copy(existing)
+    if not defaults:
+        return existing, previous
+    for field, value in defaults.items():
+        setattr(existing, field, value)
+    # started_at is set by Subscription.save() on first activation; updated_at is auto_now
+    existing.save(update_fields=[*defaults, "started_at", "updated_at"])
+    return existing, previous
+
+
+def _site_parts():
+    """Return (protocol, domain, site_root) based on SITE_URL."""
+    raw_site = (getattr(settings, "SITE_URL", "") or "").strip().rstrip("/")
+    if not raw_site:
+        return "http", "127.0.0.1:8000", "http://127.0.0.1:8000"
+
+    parts = urlsplit(raw_site)
+    if parts.scheme and parts.netloc:
+        protocol = parts.scheme
+        domain = parts.netloc
+        site_root = f"{protocol}://{domain}"
+        return protocol, domain, site_root
+
+    # Fallback if SITE_URL stored without scheme
+    domain = raw_site.replace("https://", "").replace("http://", "").split("/")[0]
+    protocol = "https"
+    site_root = f"{protocol}://{domain}"
+    return protocol, domain, site_root
+
+
+# SITE_URL doesn't change at runtime, so the site-derived parts of every email are built once
+_PROTOCOL, _DOMAIN, _SITE_ROOT = _site_parts()
+
+_STATIC_EMAIL_CTX = MappingProxyType({
+    "protocol": _PROTOCOL,
+    "domain": _DOMAIN,
+    "site_root": _SITE_ROOT,
+
+    # Internal app URLs
+    "dashboard_url": f"{_SITE_ROOT}/accounts/dashboard/",
+    "portal_url": f"{_SITE_ROOT}/subscriptions/portal/",
+
+    # Footer links
+    "support_email": "support@mintkit.co.uk",
+    "about_url": f"{_SITE_ROOT}/about/",
+    "pricing_url": f"{_SITE_ROOT}/pricing/",
+    "faq_url": f"{_SITE_ROOT}/faq/",
+})
+
+
+def base_email_ctx(profile: Profile, plan_name: str):
+    """Base context used by templates/emails/base_email.html."""
+    return {
+        **_STATIC_EMAIL_CTX,
+        "first_name": profile.user.first_name or profile.user.username,
+        "plan_name": plan_name,
+    }
+
+
+# Compiled email templates by name, so a send skips the loader lookup
+_TEMPLATES = {}
+
+
+def _get_template(name: str):
+    template = _TEMPLATES.get(name)
+    if template is None:
+        template = _TEMPLATES[name] = get_template(name)
+    return template
+
+
+def warm_email_templates() -> None:
+    """Compile the subscription email templates before the first webhook needs them."""
+    for name in (
+        "emails/subscription_confirmed.html",
+        "emails/subscription_confirmed.txt",
+        "emails/subscription_cancelled.html",
+        "emails/subscription_cancelled.txt",
+    ):
+        _get_template(name)
+
+
+def send_email(template_html, template_txt, subject, to_email, ctx):
+    """
+    Queue both HTML and text versions to go out once the caller's transaction commits,
+    so SMTP never holds the subscription row lock and a mail failure can't roll back the update.
+    The send still runs in this request, before the response (bounded by EMAIL_TIMEOUT).
+    """
+    transaction.on_commit(
+        partial(_deliver_email, template_html, template_txt, subject, to_email, ctx),
+        robust=True,
+    )
+
+
+# One mail backend connection per process, so SMTP/TLS setup is paid once rather than per email
+_mail_connection = None
+
+
+def _get_mail_connection():
+    global _mail_connection
+    if _mail_connection is None:
+        _mail_connection = get_connection(fail_silently=False)
+    return _mail_connection
+
+
+def _deliver_email(template_html, template_txt, subject, to_email, ctx):
+    """Send both HTML and text versions."""
+    html_body = _get_template(template_html).render(ctx)
+    txt_body = _get_template(template_txt).render(ctx)
+
+    connection = _get_mail_connection()
+    msg = EmailMultiAlternatives(subject=subject, body=txt_body, to=[to_email], connection=connection)
+    msg.attach_alternative(html_body, "text/html")
+    try:
+        connection.open()  # no-op while the session is still open
+        msg.send(fail_silently=False)
+    except (smtplib.SMTPException, OSError):
+        # A stale session fails in more than one way: a plain disconnect, or a 421 reply
+        # (SMTPSenderRefused) to the next command once the server has timed it out.
+        # Start a fresh session and retry once; a second failure is a real error.
+        _close_mail_connection(connection)
+        connection.open()
+        msg.send(fail_silently=False)
+
+
+def _close_mail_connection(connection) -> None:
+    try:
+        connection.close()
+    except (smtplib.SMTPException, OSError):
+        pass  # Already dead; close() has dropped it either way, so open() starts a new session
@@ -0,0 +1,380 @@
+# subscriptions/test_webhooks.py
+import hashlib
+import hmac
+import json
+import smtplib
+import time
+from unittest import mock
+
+from django.contrib.auth import get_user_model
+from django.core import mail
+from django.core.cache import cache
+from django.test import SimpleTestCase, TestCase, override_settings
+
+from .models import PmbSubscription, Subscription, SubscriptionPlan
+from .plan_cache import PLAN_CACHE_TTL, clear_plan_cache, get_active_plan, get_plan
+from .sync import _deliver_email, lock_subscription
+
+User = get_user_model()
+
+WEBHOOK_SECRET = "whsec_test_secret"
+PMB_WEBHOOK_SECRET = "whsec_test_pmb"
+
+
+def _signature(payload: bytes, secret: str = WEBHOOK_SECRET, ts: int | None = None) -> str:
+    # Same scheme Stripe uses: HMAC-SHA256 over "<timestamp>.<payload>"
+    ts = int(time.time()) if ts is None else ts
+    signed = f"{ts}.".encode() + payload
+    digest = hmac.new(secret.encode(), signed, hashlib.sha256).hexdigest()
+    return f"t={ts},v1={digest}"
+
+
+@override_settings(STRIPE_SECRET_KEY="sk_test_dummy", STRIPE_WEBHOOK_SECRET=WEBHOOK_SECRET)
+class StripeWebhookTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user(
+            username="webhookuser",
+            email="webhook@example.com",
+            password="TestPass123!",
+        )
+        self.profile = self.user.profile
+        self.plan = SubscriptionPlan.objects.create(code="basic", name="Basic")
+        self.sub = Subscription.objects.create(
+            profile=self.profile,
+            plan=self.plan,
+            status=Subscription.STATUS_ACTIVE,
+            stripe_subscription_id="sub_123",
+        )
+
+    def _post_event(self, event: dict):
+        payload = json.dumps(event).encode()
+        # Emails are sent on commit; run those callbacks as a real request would
+        with self.captureOnCommitCallbacks(execute=True):
+            return self.client.post(
+                "/subscriptions/webhook/",
+                data=payload,
+                content_type="application/json",
+                HTTP_STRIPE_SIGNATURE=_signature(payload),
+            )
+
+    def _deleted_event(self, event_id="evt_deleted_1"):
+        return {
+            "id": event_id,
+            "object": "event",
+            "type": "customer.subscription.deleted",
+            "data": {
+                "object": {
+                    "id": "sub_123",
+                    "object": "subscription",
+                    "metadata": {"profile_id": str(self.profile.pk), "plan_code": "basic"},
+                    "current_period_end": int(time.time()) + 3600,
+                    "canceled_at": int(time.time()),
+                }
+            },
+        }
+
+    def test_invalid_signature_rejected(self):
+        resp = self.client.post(
+            "/subscriptions/webhook/",
+            data=b"{}",
+            content_type="application/json",
+            HTTP_STRIPE_SIGNATURE="t=1,v1=bad",
+        )
+        self.assertEqual(resp.status_code, 400)
+
+    def test_malformed_signature_header_rejected(self):
+        resp = self.client.post(
+            "/subscriptions/webhook/",
+            data=b"{}",
+            content_type="application/json",
+            HTTP_STRIPE_SIGNATURE="not-a-stripe-header",
+        )
+        self.assertEqual(resp.status_code, 400)
+
+    def test_non_ascii_signature_rejected(self):
+        resp = self.client.post(
+            "/subscriptions/webhook/",
+            data=b"{}",
+            content_type="application/json",
+            HTTP_STRIPE_SIGNATURE=f"t={int(time.time())},v1=\u00e9",
+        )
+        self.assertEqual(resp.status_code, 400)
+
+    def test_stale_signature_rejected(self):
+        payload = json.dumps(self._deleted_event()).encode()
+        resp = self.client.post(
+            "/subscriptions/webhook/",
+            data=payload,
+            content_type="application/json",
+            HTTP_STRIPE_SIGNATURE=_signature(payload, ts=int(time.time()) - 600),
+        )
+        self.assertEqual(resp.status_code, 400)
+
+    def test_any_configured_secret_is_accepted(self):
+        payload = json.dumps(self._deleted_event()).encode()
+        with override_settings(STRIPE_WEBHOOK_SECRET=f"whsec_old, {WEBHOOK_SECRET}"):
+            resp = self.client.post(
+                "/subscriptions/webhook/",
+                data=payload,
+                content_type="application/json",
+                HTTP_STRIPE_SIGNATURE=_signature(payload),
+            )
+        self.assertEqual(resp.status_code, 200)
+
+    def test_deleted_event_cancels_subscription_and_emails(self):
+        resp = self._post_event(self._deleted_event())
+        self.assertEqual(resp.status_code, 200)
+
+        self.sub.refresh_from_db()
+        self.assertEqual(self.sub.status, Subscription.STATUS_CANCELED)
+        self.assertEqual(len(mail.outbox), 1)
+
+    def test_duplicate_event_is_processed_once(self):
+        event = self._deleted_event()
+        self._post_event(event)
+        resp = self._post_event(event)
+
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(len(mail.outbox), 1)
+
+    def _checkout_event(self):
+        return {
+            "id": "evt_checkout_1",
+            "object": "event",
+            "type": "checkout.session.completed",
+            "data": {
+                "object": {
+                    "id": "cs_test_1",
+                    "object": "checkout.session",
+                    "subscription": "sub_new",
+                    "customer": "cus_123",
+                    "payment_status": "paid",
+                    "metadata": {"profile_id": str(self.profile.pk), "plan_code": "basic"},
+                }
+            },
+        }
+
+    def test_failed_event_returns_500_and_is_processed_on_retry(self):
+        event = self._deleted_event()
+        with mock.patch("subscriptions.webhooks._send_cancellation_email", side_effect=RuntimeError):
+            resp = self._post_event(event)
+        self.assertEqual(resp.status_code, 500)
+        self.sub.refresh_from_db()
+        self.assertEqual(self.sub.status, Subscription.STATUS_ACTIVE)
+
+        resp = self._post_event(event)
+        self.assertEqual(resp.status_code, 200)
+        self.sub.refresh_from_db()
+        self.assertEqual(self.sub.status, Subscription.STATUS_CANCELED)
+        self.assertEqual(len(mail.outbox), 1)
+
+    def test_checkout_completed_uses_session_without_stripe_call(self):
+        with mock.patch("stripe.Subscription.retrieve") as retrieve:
+            resp = self._post_event(self._checkout_event())
+
+        self.assertEqual(resp.status_code, 200)
+        retrieve.assert_not_called()
+
+        created = Subscription.objects.get(stripe_subscription_id="sub_new")
+        self.assertEqual(created.status, Subscription.STATUS_ACTIVE)
+        self.assertEqual(created.stripe_customer_id, "cus_123")
+        self.assertEqual(len(mail.outbox), 1)
+
+    def test_late_checkout_event_keeps_newer_status(self):
+        # The subscription row is already active; an unpaid session arrives afterwards
+        event = self._checkout_event()
+        event["data"]["object"].update(subscription="sub_123", payment_status="unpaid")
+        resp = self._post_event(event)
+
+        self.assertEqual(resp.status_code, 200)
+        self.sub.refresh_from_db()
+        self.assertEqual(self.sub.status, Subscription.STATUS_ACTIVE)
+        self.assertEqual(self.sub.stripe_customer_id, "cus_123")
+
+    def test_late_checkout_event_does_not_reactivate_canceled_subscription(self):
+        Subscription.objects.filter(pk=self.sub.pk).update(status=Subscription.STATUS_CANCELED)
+        event = self._checkout_event()
+        event["data"]["object"]["subscription"] = "sub_123"
+        resp = self._post_event(event)
+
+        self.assertEqual(resp.status_code, 200)
+        self.sub.refresh_from_db()
+        self.assertEqual(self.sub.status, Subscription.STATUS_CANCELED)
+        self.assertEqual(len(mail.outbox), 0)
+
+    def test_checkout_completed_losing_insert_race_updates_winning_row(self):
+        # checkout_success inserted the row after this event looked for it
+        Subscription.objects.create(
+            profile=self.profile,
+            plan=self.plan,
+            status=Subscription.STATUS_ACTIVE,
+            stripe_subscription_id="sub_new",
+        )
+        lookups = []
+
+        def lock(stripe_sub_id):
+            lookups.append(stripe_sub_id)
+            return None if len(lookups) == 1 else lock_subscription(stripe_sub_id)
+
+        with mock.patch("subscriptions.webhooks.lock_subscription", side_effect=lock):
+            resp = self._post_event(self._checkout_event())
+
+        self.assertEqual(resp.status_code, 200)
+        created = Subscription.objects.get(stripe_subscription_id="sub_new")
+        self.assertEqual(created.stripe_customer_id, "cus_123")
+        # The winner already saw the transition to active and sent the email
+        self.assertEqual(len(mail.outbox), 0)
+
+    def test_update_for_unknown_plan_is_ignored(self):
+        event = {
+            "id": "evt_foreign_1",
+            "object": "event",
+            "type": "customer.subscription.updated",
+            "data": {
+                "object": {
+                    "id": "sub_123",
+                    "object": "subscription",
+                    "status": "canceled",
+                    "metadata": {"profile_id": str(self.profile.pk), "plan_code": "other_product"},
+                }
+            },
+        }
+        resp = self._post_event(event)
+
+        self.assertEqual(resp.status_code, 200)
+        self.sub.refresh_from_db()
+        self.assertEqual(self.sub.status, Subscription.STATUS_ACTIVE)
+
+
+# Price ids are read from settings at import, so tests swap the mapping itself
+@mock.patch.dict(
+    "subscriptions.webhooks._PMB_PRICE_TIERS",
+    {"price_basic": "basic", "price_pro": "pro", "price_supporter": "supporter"},
+    clear=True,
+)
+@override_settings(PMB_STRIPE_SECRET_KEY="sk_test_pmb", PMB_STRIPE_WEBHOOK_SECRET=PMB_WEBHOOK_SECRET)
+class PmbStripeWebhookTests(TestCase):
+    def _post_event(self, event: dict, secret: str = PMB_WEBHOOK_SECRET):
+        payload = json.dumps(event).encode()
+        return self.client.post(
+            "/subscriptions/webhook/pmb/",
+            data=payload,
+            content_type="application/json",
+            HTTP_STRIPE_SIGNATURE=_signature(payload, secret),
+        )
+
+    def _subscription(self, *price_ids):
+        return {
+            "id": "sub_pmb_1",
+            "object": "subscription",
+            "customer": "cus_pmb_1",
+            "status": "active",
+            "metadata": {"principal_id": "principal-abc", "plan_code": "basic"},
+            "items": {"data": [{"price": {"id": price_id}} for price_id in price_ids]},
+        }
+
+    def test_invalid_signature_rejected(self):
+        event = {"id": "evt_pmb_1", "type": "customer.subscription.updated", "data": {"object": {}}}
+        resp = self._post_event(event, secret="whsec_wrong")
+
+        self.assertEqual(resp.status_code, 400)
+        self.assertFalse(PmbSubscription.objects.exists())
+
+    def test_unhandled_event_type_acknowledged(self):
+        event = {"id": "evt_pmb_2", "type": "invoice.paid", "data": {"object": {"id": "in_1"}}}
+        resp = self._post_event(event)
+
+        self.assertEqual(resp.status_code, 200)
+        self.assertFalse(PmbSubscription.objects.exists())
+
+    def test_subscription_update_prefers_supporter_over_pro_price(self):
+        # Mid-proration the subscription carries both the old and the new price
+        event = {
+            "id": "evt_pmb_3",
+            "type": "customer.subscription.updated",
+            "data": {"object": self._subscription("price_pro", "price_supporter")},
+        }
+        resp = self._post_event(event)
+
+        self.assertEqual(resp.status_code, 200)
+        rec = PmbSubscription.objects.get(principal_id="principal-abc")
+        self.assertEqual(rec.tier, PmbSubscription.TIER_SUPPORTER)
+        self.assertEqual(rec.stripe_subscription_id, "sub_pmb_1")
+
+    def test_checkout_retrieves_subscription_with_pmb_key(self):
+        event = {
+            "id": "evt_pmb_4",
+            "type": "checkout.session.completed",
+            "data": {
+                "object": {
+                    "id": "cs_pmb_1",
+                    "client_reference_id": "principal-xyz",
+                    "subscription": "sub_pmb_1",
+                    "metadata": {"plan_code": "pro"},
+                }
+            },
+        }
+        with mock.patch("stripe.Subscription.retrieve", return_value=self._subscription("price_pro")) as retrieve:
+            resp = self._post_event(event)
+
+        self.assertEqual(resp.status_code, 200)
+        retrieve.assert_called_once_with("sub_pmb_1", api_key="sk_test_pmb")
+        rec = PmbSubscription.objects.get(principal_id="principal-xyz")
+        self.assertEqual(rec.tier, PmbSubscription.TIER_PRO)
+
+
+class PlanCacheTests(TestCase):
+    def test_saving_a_plan_refreshes_cached_lookup(self):
+        plan = SubscriptionPlan.objects.create(code="pro", name="Pro")
+        self.assertEqual(get_plan("pro").name, "Pro")
+
+        plan.name = "Pro Plus"
+        plan.save()
+        self.assertEqual(get_plan("pro").name, "Pro Plus")
+
+    def test_deleting_a_plan_drops_cached_lookup(self):
+        plan = SubscriptionPlan.objects.create(code="legacy", name="Legacy")
+        self.assertIsNotNone(get_plan("legacy"))
+
+        plan.delete()
+        self.assertIsNone(get_plan("legacy"))
+
+    def test_inactive_plan_is_not_offered(self):
+        SubscriptionPlan.objects.create(code="retired", name="Retired", is_active=False)
+        self.assertIsNotNone(get_plan("retired"))
+        self.assertIsNone(get_active_plan("retired"))
+
+    def test_edits_from_other_processes_apply_after_ttl(self):
+        SubscriptionPlan.objects.create(code="seasonal", name="Seasonal")
+        self.assertIsNotNone(get_active_plan("seasonal"))
+
+        # A queryset update sends no signal, like an admin edit served by another worker
+        SubscriptionPlan.objects.filter(code="seasonal").update(is_active=False)
+        self.assertIsNotNone(get_active_plan("seasonal"))
+
+        self.addCleanup(clear_plan_cache)
+        later = time.monotonic() + PLAN_CACHE_TTL + 1
+        with mock.patch("subscriptions.plan_cache.time.monotonic", return_value=later):
+            self.assertIsNone(get_active_plan("seasonal"))
+
+
+class MailDeliveryTests(SimpleTestCase):
+    def test_timed_out_session_is_reopened_and_retried(self):
+        # A server that timed out the idle session answers the next command with 421
+        connection = mock.Mock()
+        connection.send_messages.side_effect = [
+            smtplib.SMTPSenderRefused(421, b"4.4.2 Error: timeout exceeded", "noreply@example.com"),
+            1,
+        ]
+        with mock.patch("subscriptions.sync._get_mail_connection", return_value=connection):
+            _deliver_email(
+                "emails/subscription_confirmed.html",
+                "emails/subscription_confirmed.txt",
+                "Subscription confirmed",
+                "webhook@example.com",
+                {},
+            )
+
+        self.assertEqual(connection.send_messages.call_count, 2)
+        connection.close.assert_called_once()
@@ -9,15 +9,22 @@ import json
 from django.conf import settings
 from django.contrib import messages
 from django.contrib.auth.decorators import login_required
-from django.core.mail import EmailMultiAlternatives
+from django.db import transaction
 from django.shortcuts import redirect
-from django.template.loader import render_to_string
 from django.urls import reverse
 from django.utils import timezone
 
 from accounts.models import Profile
 from .models import Subscription, SubscriptionPlan
+from .plan_cache import get_active_plan, get_plan
 from .stripe_service import init_stripe, get_stripe_price_id
+from .sync import (
+    base_email_ctx,
+    map_stripe_status,
+    send_email,
+    upsert_subscription,
+    utc_from_ts,
+)
 
 from django.http import JsonResponse, HttpResponse
 from .models import PmbSubscription
@@ -95,56 +102,23 @@ def _trial_eligible(profile: Profile) -> bool:
 
 def _send_subscription_email_confirmed(profile: Profile, plan: SubscriptionPlan) -> None:
     """
-    Sends the styled subscription confirmed email (HTML + text fallback).
-    Includes protocol/domain so base_email.html can render the banner + watermark images.
+    Queues the styled subscription confirmed email (HTML + text fallback),
+    sent once the surrounding transaction commits.
     """
     to_email = profile.contact_email or profile.user.email
     if not to_email:
         return
 
-    raw_site = (settings.SITE_URL or "").rstrip("/")
-    parts = urlsplit(raw_site)
+    # Site URLs come precomputed; only the per-user fields are added here
+    ctx = base_email_ctx(profile, plan.name)
 
-    # Build protocol/domain even if SITE_URL is missing a scheme
-    if parts.scheme and parts.netloc:
-        protocol = parts.scheme
-        domain = parts.netloc
-        site_root = f"{protocol}://{domain}"
-    else:
-        # Fallback: treat SITE_URL as a domain
-        domain = raw_site.replace("https://", "").replace("http://", "").split("/")[0]
-        protocol = "https"
-        site_root = f"{protocol}://{domain}"
-
-    portal_url = f"{site_root}{reverse('subscriptions_billing_portal')}"
-    dashboard_url = f"{site_root}{reverse('dashboard')}"
-
-    ctx = {
-        # Content
-        "first_name": profile.user.first_name or profile.user.username,
-        "plan_name": plan.name,
-        "dashboard_url": dashboard_url,
-        "portal_url": portal_url,
-
-        # base_email.html needs these for full header/watermark + Visit site button
-        "protocol": protocol,
-        "domain": domain,
-        "site_root": site_root,
-
-        # Optional footer links (nice to have)
-        "about_url": f"{site_root}/about/",
-        "pricing_url": f"{site_root}/pricing/",
-        "faq_url": f"{site_root}/faq/",
-        "support_email": "support@mintkit.co.uk",
-    }
-
-    subject = f"Your MintKit {plan.name} subscription is active ✅"
-    html_body = render_to_string("emails/subscription_confirmed.html", ctx)
-    text_body = render_to_string("emails/subscription_confirmed.txt", ctx)
-
-    msg = EmailMultiAlternatives(subject=subject, body=text_body, to=[to_email])
-    msg.attach_alternative(html_body, "text/html")
-    msg.send(fail_silently=False)
+    send_email(
+        "emails/subscription_confirmed.html",
+        "emails/subscription_confirmed.txt",
+        f"Your MintKit {plan.name} subscription is active ✅",
+        to_email,
+        ctx,
+    )
 
 
 
@@ -164,7 +138,7 @@ def start_trial(request):
         messages.error(request, "Free trial has already been used on this account.")
         return redirect("pricing")
 
-    trial_plan = SubscriptionPlan.objects.filter(code="trial", is_active=True).first()
+    trial_plan = get_active_plan("trial")
     if not trial_plan:
         messages.error(request, "Trial plan is not configured.")
         return redirect("pricing")
@@ -212,7 +186,7 @@ def checkout(request, plan_code: str):
         messages.info(request, "Trial doesn’t require payment.")
         return redirect("pricing")
 
-    plan = SubscriptionPlan.objects.filter(code=plan_code, is_active=True).first()
+    plan = get_active_plan(plan_code)
     if not plan:
         messages.error(request, "That plan is not available.")
         return redirect("pricing")
@@ -289,7 +263,7 @@ def checkout_success(request):
     md = session.get("metadata") or {}
     plan_code = (md.get("plan_code") or "basic").strip().lower()
 
-    plan = SubscriptionPlan.objects.filter(code=plan_code).first()
+    plan = get_plan(plan_code)
     if not plan:
         messages.error(request, "Subscription plan not found in database.")
         return redirect("pricing")
@@ -299,77 +273,61 @@ def checkout_success(request):
     stripe_status = (stripe_sub.get("status") or "").strip().lower()
 
     cancel_at_period_end = bool(stripe_sub.get("cancel_at_period_end", False))
-    cancel_at = stripe_sub.get("cancel_at")          # scheduled cancellation time
-    canceled_at = stripe_sub.get("canceled_at")      # actual cancellation time (if canceled)
-
-    # Map Stripe status to local values without collapsing everything to "canceled"
-    status_map = {
-        "active": Subscription.STATUS_ACTIVE,
-        "trialing": Subscription.STATUS_TRIALING,
-        "past_due": Subscription.STATUS_PAST_DUE,
-        "unpaid": Subscription.STATUS_PAST_DUE,
-        "incomplete": Subscription.STATUS_INCOMPLETE,
-        "incomplete_expired": Subscription.STATUS_INCOMPLETE,
-        "canceled": Subscription.STATUS_CANCELED,
-        "cancelled": Subscription.STATUS_CANCELED,  # defensive spelling
-    }
-    local_status = status_map.get(stripe_status, Subscription.STATUS_CANCELED)
-
-    current_period_end = stripe_sub.get("current_period_end")
-    current_period_end_dt = (
-        datetime.datetime.fromtimestamp(current_period_end, tz=datetime.timezone.utc)
-        if current_period_end
-        else None
-    )
-
-    cancel_at_dt = (
-        datetime.datetime.fromtimestamp(cancel_at, tz=datetime.timezone.utc)
-        if cancel_at
-        else None
-    )
-    canceled_at_dt = (
-        datetime.datetime.fromtimestamp(canceled_at, tz=datetime.timezone.utc)
-        if canceled_at
-        else None
-    )
-
-    existing = Subscription.objects.filter(profile=profile, stripe_subscription_id=stripe_subscription_id).first()
-    prev_status = existing.status if existing else None
-
-    sub_obj, _created = Subscription.objects.update_or_create(
-        profile=profile,
-        stripe_subscription_id=stripe_subscription_id,
-        defaults={
-            "plan": plan,
-            "status": local_status,
-            "stripe_customer_id": customer_id or "",
-            "current_period_end": current_period_end_dt,
-            "cancel_at_period_end": cancel_at_period_end,
-            "cancel_at": cancel_at_dt,
-            "canceled_at": canceled_at_dt,
-        },
-    )
+    # Map Stripe status to local values with the webhook's shared (module-level) map
+    local_status = map_stripe_status(stripe_status)
+
+    # Stripe timestamps are UTC unix seconds: period end, scheduled and actual cancellation
+    current_period_end_dt = utc_from_ts(stripe_sub.get("current_period_end"))
+    cancel_at_dt = utc_from_ts(stripe_sub.get("cancel_at"))
+    canceled_at_dt = utc_from_ts(stripe_sub.get("canceled_at"))
+
+    # The checkout webhook handles the same subscription concurrently. An existing row is locked
+    # here; a new one is claimed by whichever INSERT wins uniq_profile_stripe_sub, and the loser
+    # updates that row instead (see upsert_subscription). Either way exactly one side sees the
+    # transition to active. The email goes out after commit, never for a rolled-back write.
+    with transaction.atomic():
+        existing = (
+            Subscription.objects.select_for_update()
+            .filter(profile=profile, stripe_subscription_id=stripe_subscription_id)
+            .first()
+        )
 
-    # If a paid subscription became active, cancel any existing local trial record
-    if plan_code != "trial":
-        Subscription.objects.filter(
-            profile=profile,
-            plan__code="trial",
-            status=Subscription.STATUS_TRIALING,
-            stripe_subscription_id="",
-        ).update(
-            status=Subscription.STATUS_CANCELED,
-            canceled_at=timezone.now(),
-            cancel_at=None,
-            cancel_at_period_end=False,
+        # Row already loaded (and locked) above: one UPDATE or one INSERT
+        sub_obj, previous = upsert_subscription(
+            profile,
+            stripe_subscription_id,
+            existing,
+            {
+                "plan": plan,
+                "status": local_status,
+                "stripe_customer_id": customer_id or "",
+                "current_period_end": current_period_end_dt,
+                "cancel_at_period_end": cancel_at_period_end,
+                "cancel_at": cancel_at_dt,
+                "canceled_at": canceled_at_dt,
+            },
         )
 
-    # Send confirmation email only when transitioning into active
-    if prev_status != Subscription.STATUS_ACTIVE and sub_obj.status == Subscription.STATUS_ACTIVE:
-        try:
+        # If a paid subscription became active, cancel any existing local trial record.
+        # Filter on the cached trial plan id so the UPDATE needs no JOIN.
+        trial_plan = get_plan("trial") if plan_code != "trial" else None
+        if trial_plan:
+            Subscription.objects.filter(
+                profile_id=profile.pk,
+                plan_id=trial_plan.pk,
+                status=Subscription.STATUS_TRIALING,
+                stripe_subscription_id="",
+            ).update(
+                status=Subscription.STATUS_CANCELED,
+                canceled_at=timezone.now(),
+                cancel_at=None,
+                cancel_at_period_end=False,
+            )
+
+        # Send confirmation email only when transitioning into active
+        prev_status = previous.status if previous else None
+        if prev_status != Subscription.STATUS_ACTIVE and sub_obj.status == Subscription.STATUS_ACTIVE:
             _send_subscription_email_confirmed(profile, plan)
-        except Exception:
-            logger.exception("Failed sending subscription confirmed email")
 
     messages.success(request, "Subscription confirmed! Welcome aboard 🚀")
     return redirect("dashboard")
@@ -498,8 +456,9 @@ def pmb_checkout(request):
     except Exception:
         return JsonResponse({"error": "Invalid request"}, status=400)
 
-    stripe.api_key = (getattr(settings, "PMB_STRIPE_SECRET_KEY", "") or "").strip()
-    if not stripe.api_key:
+    # Per-call key: the global stripe.api_key stays on the MintKit account
+    pmb_key = (getattr(settings, "PMB_STRIPE_SECRET_KEY", "") or "").strip()
+    if not pmb_key:
         return JsonResponse({"error": "PMB_STRIPE_SECRET_KEY not configured"}, status=500)
 
     success_url = f"{return_url}/?plan={plan}&session_id={{CHECKOUT_SESSION_ID}}"
@@ -513,6 +472,7 @@ def pmb_checkout(request):
         client_reference_id=principal_id,
         metadata={"principal_id": principal_id, "plan_code": plan},
         subscription_data={"metadata": {"principal_id": principal_id, "plan_code": plan}},
+        api_key=pmb_key,
     )
 
     return JsonResponse({"url": session.url})
@@ -548,13 +508,15 @@ def pmb_portal(request):
     if not sub or not sub.stripe_customer_id:
         return JsonResponse({"error": "No Stripe customer for this principal"}, status=404)
 
-    stripe.api_key = (getattr(settings, "PMB_STRIPE_SECRET_KEY", "") or "").strip()
-    if not stripe.api_key:
+    # Per-call key: the global stripe.api_key stays on the MintKit account
+    pmb_key = (getattr(settings, "PMB_STRIPE_SECRET_KEY", "") or "").strip()
+    if not pmb_key:
         return JsonResponse({"error": "PMB_STRIPE_SECRET_KEY not configured"}, status=500)
 
     portal = stripe.billing_portal.Session.create(
         customer=sub.stripe_customer_id,
         return_url=return_url,
+        api_key=pmb_key,
     )
     return JsonResponse({"url": portal.url})
 
@@ -1,415 +1,585 @@
 # subscriptions/webhooks.py
 import datetime
+import hashlib
+import hmac
+import json
 import logging
-from urllib.parse import urlsplit
+import re
+import time
+from functools import lru_cache
 
 import stripe
 from django.conf import settings
-from django.core.mail import EmailMultiAlternatives
+from django.core.cache import cache
+from django.db import IntegrityError, transaction
+from django.db.models import Value
+from django.db.models.functions import Coalesce, NullIf
 from django.http import HttpResponse
-from django.template.loader import render_to_string
 from django.views.decorators.csrf import csrf_exempt
 from django.views.decorators.http import require_POST
 
 from accounts.models import Profile
-from .models import Subscription, SubscriptionPlan, PmbSubscription
-from .stripe_service import init_stripe
+from .models import Subscription, PmbSubscription, StripeWebhookEvent
+from .plan_cache import get_plan, known_plan_codes
+from .sync import (
+    STRIPE_STATUS_MAP,
+    base_email_ctx,
+    lock_subscription,
+    map_stripe_status,
+    send_email,
+    upsert_subscription,
+    utc_from_ts,
+)
 
 logger = logging.getLogger(__name__)
 
+# Max age/skew of a webhook signature timestamp, as in Stripe's own verification
+WEBHOOK_TOLERANCE = 300
 
-def _utc_from_ts(ts):
-    """Stripe timestamps are unix seconds; convert to timezone-aware UTC datetime."""
-    if not ts:
-        return None
-    return datetime.datetime.fromtimestamp(ts, tz=datetime.timezone.utc)
+# Subscription metadata fetched from Stripe as a checkout fallback
+SUBSCRIPTION_METADATA_TTL = 60 * 5
+
+
+_UTC = datetime.timezone.utc
+
+
+def _profiles():
+    """Profiles with their notification email (contact_email, else the user's email) resolved in SQL."""
+    # The user is joined for the email greeting; skip logo/business_name etc.
+    return (
+        Profile.objects.select_related("user")
+        .only("id", "user__first_name", "user__username", "user__email")
+        .annotate(
+            notify_email=Coalesce(NullIf("contact_email", Value("")), "user__email"),
+        )
+    )
 
 
 def _profile_email(profile: Profile) -> str:
     """Preferred email for subscription notifications."""
-    return (getattr(profile, "contact_email", "") or profile.user.email or "").strip()
-
+    email = getattr(profile, "notify_email", None)
+    if email is None:
+        email = getattr(profile, "contact_email", "") or profile.user.email
+    return (email or "").strip()
+
+
+def _send_cancellation_email(profile: Profile, plan_name: str, ends_on, subject: str) -> None:
+    """Send the subscription_cancelled email (scheduled, immediate or ended), if the profile has an address."""
+    to_email = _profile_email(profile)
+    if not to_email:
+        return
+
+    ctx = base_email_ctx(profile, plan_name)
+    ctx["ends_on"] = ends_on
+    send_email(
+        "emails/subscription_cancelled.html",
+        "emails/subscription_cancelled.txt",
+        subject,
+        to_email,
+        ctx,
+    )
 
-def _site_parts():
-    """Return (protocol, domain, site_root) based on SITE_URL."""
-    raw_site = (getattr(settings, "SITE_URL", "") or "").strip().rstrip("/")
-    if not raw_site:
-        return "http", "127.0.0.1:8000", "http://127.0.0.1:8000"
 
-    parts = urlsplit(raw_site)
-    if parts.scheme and parts.netloc:
-        protocol = parts.scheme
-        domain = parts.netloc
-        site_root = f"{protocol}://{domain}"
-        return protocol, domain, site_root
+def _profile_from_metadata(md):
+    """Profile named in Stripe metadata (set at Checkout creation), for subscriptions not yet stored locally."""
+    profile_id = (md or {}).get("profile_id")
+    if not profile_id:
+        return None
+    return _profiles().filter(pk=profile_id).first()
 
-    # Fallback if SITE_URL stored without scheme
-    domain = raw_site.replace("https://", "").replace("http://", "").split("/")[0]
-    protocol = "https"
-    site_root = f"{protocol}://{domain}"
-    return protocol, domain, site_root
 
+def _clean_code(value, canonical) -> str:
+    """Stripped, lowercased code; values already in `canonical` (the usual case) pass straight through."""
+    if not value:
+        return ""
+    return value if value in canonical else value.strip().lower()
+
+
+def _checkout_session_status(session) -> str:
+    """Local status for a completed Checkout Session, without fetching the subscription."""
+    if session.get("payment_status") in ("paid", "no_payment_required"):
+        return Subscription.STATUS_ACTIVE
+    return Subscription.STATUS_INCOMPLETE
+
+
+def _subscription_metadata(stripe_sub_id: str) -> dict:
+    """Fallback for sessions without metadata: read it off the subscription (cached briefly)."""
+    key = f"stripe_sub_md:{stripe_sub_id}"
+    md = cache.get(key)
+    if md is None:
+        # Explicit key, so this never depends on what the global stripe.api_key holds
+        stripe_sub = stripe.Subscription.retrieve(stripe_sub_id, api_key=settings.STRIPE_SECRET_KEY)
+        md = dict(stripe_sub.get("metadata") or {})
+        cache.set(key, md, timeout=SUBSCRIPTION_METADATA_TTL)
+    return md
+
+
+def _metadata_plan_code(md) -> str:
+    """Normalised plan_code from Stripe metadata ("" when absent)."""
+    return _clean_code((md or {}).get("plan_code"), known_plan_codes())
+
+
+def _is_foreign_plan(plan_code: str) -> bool:
+    """True when metadata names a plan this site doesn't sell (e.g. another product on the account)."""
+    return bool(plan_code) and plan_code not in known_plan_codes()
+
+
+def _handle_checkout_completed(session):
+    """checkout.session.completed: link the new Stripe subscription to the profile."""
+    stripe_sub_id = session.get("subscription")
+    if not stripe_sub_id:
+        return
+
+    # Checkout metadata already carries profile/plan; only ask Stripe when it is missing
+    md = session.get("metadata") or _subscription_metadata(stripe_sub_id)
+    plan_code = _metadata_plan_code(md) or "basic"
+
+    existing = lock_subscription(stripe_sub_id)
+    profile = existing.profile if existing else _profile_from_metadata(md)
+    if not profile:
+        logger.warning("Webhook: cannot link checkout to profile (missing metadata/profile).")
+        return
+
+    customer_id = session.get("customer")
+    if customer_id and hasattr(profile, "stripe_customer_id"):
+        if profile.stripe_customer_id != customer_id:
+            profile.stripe_customer_id = customer_id
+            profile.save(update_fields=["stripe_customer_id"])
+
+    plan = get_plan(plan_code)
+    if not plan:
+        logger.warning("Webhook: plan not found in DB: %s", plan_code)
+        return
+
+    # Period end / cancel flags follow in customer.subscription.updated (and checkout_success).
+    # The session's payment state only seeds the status of a new row: events arrive out of order
+    # (and failed ones are retried), so a late checkout event must not overwrite the status,
+    # or the plan, that subscription events or checkout_success have written since.
+    sub_obj, previous = upsert_subscription(
+        profile,
+        stripe_sub_id,
+        existing,
+        {"stripe_customer_id": customer_id} if customer_id else {},
+        create_defaults={
+            "plan": plan,
+            "status": _checkout_session_status(session),
+            "stripe_customer_id": customer_id or "",
+        },
+    )
 
-def _base_email_ctx(profile: Profile, plan_name: str):
-    """Base context used by templates/emails/base_email.html."""
-    protocol, domain, site_root = _site_parts()
+    # Cancel local trial record if paid activated.
+    # Filter on the cached trial plan id (no JOIN); without a trial plan there is nothing to cancel.
+    trial_plan = get_plan("trial") if plan_code != "trial" else None
+    if trial_plan:
+        Subscription.objects.filter(
+            profile_id=profile.pk,
+            plan_id=trial_plan.pk,
+            status=Subscription.STATUS_TRIALING,
+            stripe_subscription_id="",
+        ).update(
+            status=Subscription.STATUS_CANCELED,
+            canceled_at=datetime.datetime.now(_UTC),
+            cancel_at=None,
+            cancel_at_period_end=False,
+        )
 
-    return {
-        "first_name": profile.user.first_name or profile.user.username,
-        "plan_name": plan_name,
+    # Send "active" email only on transition to ACTIVE
+    prev_status = previous.status if previous else None
+    if prev_status != Subscription.STATUS_ACTIVE and sub_obj.status == Subscription.STATUS_ACTIVE:
+        to_email = _profile_email(profile)
+        if to_email:
+            ctx = base_email_ctx(profile, plan.name)
+            send_email(
+                "emails/subscription_confirmed.html",
+                "emails/subscription_confirmed.txt",
+                f"Your MintKit {plan.name} subscription is active ✅",
+                to_email,
+                ctx,
+            )
 
-        "protocol": protocol,
-        "domain": domain,
-        "site_root": site_root,
 
-        # Internal app URLs
-        "dashboard_url": f"{site_root}/accounts/dashboard/",
-        "portal_url": f"{site_root}/subscriptions/portal/",
+def _handle_subscription_updated(stripe_sub):
+    """customer.subscription.updated: sync status/cancel flags (cancel scheduled/resumed/etc)."""
+    sub_id = stripe_sub.get("id")
+    md = stripe_sub.get("metadata") or {}
+    md_plan_code = _metadata_plan_code(md)
+    if _is_foreign_plan(md_plan_code):
+        logger.info("Webhook: ignoring update for sub=%s with unknown plan.", sub_id)
+        return
+
+    existing = lock_subscription(sub_id)
+    profile = existing.profile if existing else _profile_from_metadata(md)
+    if not profile:
+        return
+
+    stripe_status = _clean_code(stripe_sub.get("status"), STRIPE_STATUS_MAP)
+    new_status = map_stripe_status(stripe_status)
+
+    cancel_at_period_end = bool(stripe_sub.get("cancel_at_period_end", False))
+    current_period_end, cancel_at, canceled_at = map(
+        utc_from_ts,
+        (stripe_sub.get("current_period_end"), stripe_sub.get("cancel_at"), stripe_sub.get("canceled_at")),
+    )
+    customer_id = stripe_sub.get("customer")
+
+    plan = get_plan(md_plan_code or "basic")
+
+    # If metadata is missing, keep previous plan if available
+    if not plan and existing:
+        plan = existing.plan
+    if not plan:
+        logger.warning("Webhook: cannot resolve plan for sub=%s (no metadata and no local plan).", sub_id)
+        return
+
+    sub_obj, previous = upsert_subscription(
+        profile,
+        sub_id,
+        existing,
+        {
+            "plan": plan,
+            "status": new_status,
+            "stripe_customer_id": customer_id or "",
+            "current_period_end": current_period_end,
+            "cancel_at_period_end": cancel_at_period_end,
+            "cancel_at": cancel_at,
+            "canceled_at": canceled_at,
+        },
+    )
 
-        # Footer links
-        "support_email": "support@mintkit.co.uk",
-        "about_url": f"{site_root}/about/",
-        "pricing_url": f"{site_root}/pricing/",
-        "faq_url": f"{site_root}/faq/",
-    }
+    prev_status = previous.status if previous else None
+    prev_cancel_flag = previous.cancel_at_period_end if previous else False
+    prev_cancel_at = previous.cancel_at if previous else None
+
+    # Stripe can represent "scheduled cancellation" in two ways:
+    # - cancel_at_period_end=True (end of billing period)
+    # - cancel_at=<timestamp>     (portal sometimes sets this while leaving cancel_at_period_end False)
+    scheduled_now = bool(cancel_at_period_end or (cancel_at is not None))
+    scheduled_prev = bool(prev_cancel_flag or (prev_cancel_at is not None))
+
+    # Use cancel_at if present, otherwise fall back to current_period_end
+    ends_on = cancel_at or current_period_end
+
+    # Diagnostic trace for every update event; skip building the args unless DEBUG is on
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug(
+            "CANCEL CHECK: sub=%s scheduled_prev=%s scheduled_now=%s prev_cap_end=%s prev_cancel_at=%s "
+            "cap_end=%s cancel_at=%s new_status=%s stripe_status=%s",
+            sub_id,
+            scheduled_prev,
+            scheduled_now,
+            prev_cancel_flag,
+            prev_cancel_at,
+            cancel_at_period_end,
+            cancel_at,
+            new_status,
+            stripe_status,
+        )
 
+    # The two emails below are exclusive: one needs an active/trialing status, the other canceled.
+
+    # Email when user schedules cancellation (either style)
+    if (not scheduled_prev) and scheduled_now and new_status in (
+        Subscription.STATUS_ACTIVE,
+        Subscription.STATUS_TRIALING,
+    ):
+        logger.debug(
+            "CANCEL EMAIL PATH HIT: sub=%s ends_on=%s cap_end=%s cancel_at=%s status=%s",
+            sub_id,
+            ends_on,
+            cancel_at_period_end,
+            cancel_at,
+            stripe_status,
+        )
+        _send_cancellation_email(
+            profile, plan.name, ends_on, "Your MintKit subscription will end (unless resumed)"
+        )
 
-def _send_email(template_html, template_txt, subject, to_email, ctx):
-    """Send both HTML and text versions."""
-    html_body = render_to_string(template_html, ctx)
-    txt_body = render_to_string(template_txt, ctx)
+    # Email when cancelled immediately (status becomes canceled)
+    if prev_status != Subscription.STATUS_CANCELED and sub_obj.status == Subscription.STATUS_CANCELED:
+        _send_cancellation_email(
+            profile, plan.name, current_period_end, "Your MintKit subscription has been cancelled"
+        )
 
-    msg = EmailMultiAlternatives(subject=subject, body=txt_body, to=[to_email])
-    msg.attach_alternative(html_body, "text/html")
-    msg.send(fail_silently=False)
 
+def _handle_subscription_deleted(stripe_sub):
+    """customer.subscription.deleted: the subscription has ended."""
+    if _is_foreign_plan(_metadata_plan_code(stripe_sub.get("metadata"))):
+        logger.info("Webhook: ignoring delete for sub=%s with unknown plan.", stripe_sub.get("id"))
+        return
 
-def _find_profile_for_subscription(stripe_sub):
-    """
-    Prefer subscription metadata (set at Checkout creation).
-    Fallback to local DB via stripe_subscription_id.
-    """
-    md = stripe_sub.get("metadata") or {}
-    profile_id = md.get("profile_id")
+    sub_obj = lock_subscription(stripe_sub.get("id"))
+    if not sub_obj:
+        return
+    profile = sub_obj.profile
 
-    if profile_id:
-        try:
-            return Profile.objects.get(pk=profile_id)
-        except Profile.DoesNotExist:
-            return None
+    current_period_end = utc_from_ts(stripe_sub.get("current_period_end"))
+    canceled_at = utc_from_ts(stripe_sub.get("canceled_at")) or datetime.datetime.now(_UTC)
 
-    sub_id = stripe_sub.get("id")
-    local = (
-        Subscription.objects.select_related("profile")
-        .filter(stripe_subscription_id=sub_id)
-        .first()
+    # Nothing below reads the instance's status fields, so write straight to the row
+    Subscription.objects.filter(pk=sub_obj.pk).update(
+        status=Subscription.STATUS_CANCELED,
+        cancel_at_period_end=False,
+        cancel_at=None,
+        canceled_at=canceled_at,
+        updated_at=datetime.datetime.now(_UTC),
     )
-    return local.profile if local else None
 
+    # Email: always notify on DELETE events (service ended)
+    plan_name = sub_obj.plan.name if sub_obj.plan else "subscription"
+    _send_cancellation_email(profile, plan_name, current_period_end, "Your MintKit subscription has ended")
+
+
+_EVENT_HANDLERS = {
+    "checkout.session.completed": _handle_checkout_completed,
+    "customer.subscription.updated": _handle_subscription_updated,
+    "customer.subscription.deleted": _handle_subscription_deleted,
+}
 
-def _map_stripe_status(stripe_status: str) -> str:
-    status = (stripe_status or "").strip().lower()
-    status_map = {
-        "active": Subscription.STATUS_ACTIVE,
-        "trialing": Subscription.STATUS_TRIALING,
-        "past_due": Subscription.STATUS_PAST_DUE,
-        "unpaid": Subscription.STATUS_PAST_DUE,
-        "incomplete": Subscription.STATUS_INCOMPLETE,
-        "incomplete_expired": Subscription.STATUS_INCOMPLETE,
-        "canceled": Subscription.STATUS_CANCELED,
-        "cancelled": Subscription.STATUS_CANCELED,
-    }
-    return status_map.get(status, Subscription.STATUS_CANCELED)
+# Matches every "type": "..." pair in a raw payload. Nested objects have "type" keys too,
+# so this can only rule events out: if no value is a handled event type, nothing to do.
+_TYPE_VALUE_RE = re.compile(rb'"type"\s*:\s*"([^"]+)"')
+_HANDLED_EVENT_TYPES = frozenset(t.encode() for t in _EVENT_HANDLERS)
+
+
+def _may_be_handled(payload: bytes) -> bool:
+    return not _HANDLED_EVENT_TYPES.isdisjoint(_TYPE_VALUE_RE.findall(payload))
+
+
+def _record_event(event_id: str) -> bool:
+    """Store a processed event id; False if it was already there (a Stripe redelivery)."""
+    try:
+        # Savepoint, so a duplicate leaves the surrounding transaction usable
+        with transaction.atomic():
+            StripeWebhookEvent.objects.create(event_id=event_id)
+    except IntegrityError:
+        return False
+    return True
+
+
+@lru_cache(maxsize=4)
+def _webhook_secrets(raw: str) -> tuple:
+    """STRIPE_WEBHOOK_SECRET may list several comma-separated secrets (rotation / extra endpoints)."""
+    return tuple(s.strip().encode() for s in raw.split(",") if s.strip())
+
+
+def _verify_signature(payload: bytes, sig_header: str, secrets: str) -> bool:
+    """
+    Check a Stripe-Signature header ("t=...,v1=...") against each of the comma-separated secrets.
+    Malformed or stale headers are rejected before any HMAC is computed.
+    """
+    timestamp, signatures = "", []
+    for item in sig_header.split(","):
+        key, _, value = item.strip().partition("=")
+        if key == "t":
+            timestamp = value
+        elif key == "v1":
+            # Bytes: compare_digest raises TypeError on non-ASCII str, and the header is untrusted
+            signatures.append(value.encode("utf-8", "surrogateescape"))
+
+    if not timestamp.isdigit() or not signatures:
+        return False
+    if abs(time.time() - int(timestamp)) > WEBHOOK_TOLERANCE:
+        return False
+
+    signed = timestamp.encode() + b"." + payload
+    for secret in _webhook_secrets(secrets):
+        expected = hmac.new(secret, signed, hashlib.sha256).hexdigest().encode()
+        if any(hmac.compare_digest(expected, sig) for sig in signatures):
+            return True
+    return False
 
 
 @csrf_exempt
 @require_POST
 def stripe_webhook(request):
     """Stripe webhook endpoint."""
-    init_stripe()
-
     payload = request.body
     sig_header = request.META.get("HTTP_STRIPE_SIGNATURE", "")
 
+    if not _verify_signature(payload, sig_header, settings.STRIPE_WEBHOOK_SECRET):
+        return HttpResponse(status=400)
+
+    # Most event types Stripe sends aren't handled here; acknowledge those without parsing
+    if not _may_be_handled(payload):
+        return HttpResponse(status=200)
+
+    # Parse into plain dicts: handlers only use .get()/[] access,
+    # so Stripe's recursive StripeObject wrapping (construct_event) is skipped.
     try:
-        event = stripe.Webhook.construct_event(
-            payload=payload,
-            sig_header=sig_header,
-            secret=settings.STRIPE_WEBHOOK_SECRET,
-        )
+        event = json.loads(payload)
     except ValueError:
         return HttpResponse(status=400)
-    except stripe.error.SignatureVerificationError:
-        return HttpResponse(status=400)
 
+    event_id = event.get("id")
     event_type = event.get("type", "")
     obj = event["data"]["object"]
 
+    handler = _EVENT_HANDLERS.get(event_type)
+    if handler is None:
+        return HttpResponse(status=200)
+
     try:
-        # ------------------------------------------------------------
-        # 1) Checkout completed
-        # ------------------------------------------------------------
-        if event_type == "checkout.session.completed":
-            session = obj
-            stripe_sub_id = session.get("subscription")
-            if not stripe_sub_id:
+        # One transaction per event; row locks in the handlers serialise concurrent deliveries
+        # for the same subscription so previous-status checks (and emails) happen once.
+        # The event id commits only with the handler's changes: redeliveries of a processed
+        # event are skipped, while one that failed is processed again on Stripe's retry.
+        with transaction.atomic():
+            if event_id and not _record_event(event_id):
+                logger.info("Webhook: duplicate event %s ignored.", event_id)
                 return HttpResponse(status=200)
+            handler(obj)
+    except Exception:
+        # The event id rolled back with the handler's changes, so ask Stripe to redeliver it
+        logger.exception("Stripe webhook processing failed for event=%s", event_type)
+        return HttpResponse(status=500)
 
-            stripe_sub = stripe.Subscription.retrieve(stripe_sub_id)
+    return HttpResponse(status=200)
+# -------------------------
+# PlanMyBalance Stripe webhook (separate Stripe account/keys)
+# -------------------------
+# PMB price id -> tier, read from settings once (unset prices left out).
+# Built lowest tier first so a price shared by mistake resolves to the higher tier.
+_PMB_PRICE_TIERS = {
+    price: tier
+    for tier, price in (
+        ("basic", (getattr(settings, "PMB_STRIPE_PRICE_BASIC", "") or "").strip()),
+        ("pro", (getattr(settings, "PMB_STRIPE_PRICE_PRO", "") or "").strip()),
+        ("supporter", (getattr(settings, "PMB_STRIPE_PRICE_SUPPORTER", "") or "").strip()),
+    )
+    if price
+}
+_PMB_TIER_PRIORITY = ("supporter", "pro", "basic")
 
-            md = session.get("metadata") or stripe_sub.get("metadata") or {}
-            plan_code = (md.get("plan_code") or "basic").strip().lower()
-            profile_id = md.get("profile_id")
+# Events whose payload is the subscription itself
+_PMB_SUBSCRIPTION_EVENTS = frozenset({
+    "customer.subscription.created",
+    "customer.subscription.updated",
+    "customer.subscription.deleted",
+})
+_PMB_HANDLED_EVENTS = _PMB_SUBSCRIPTION_EVENTS | {"checkout.session.completed", "invoice.payment_failed"}
 
-            profile = Profile.objects.filter(pk=profile_id).first() if profile_id else None
-            if not profile:
-                profile = _find_profile_for_subscription(stripe_sub)
-            if not profile:
-                logger.warning("Webhook: cannot link checkout to profile (missing metadata/profile).")
-                return HttpResponse(status=200)
 
-            customer_id = session.get("customer") or stripe_sub.get("customer")
-            if customer_id and hasattr(profile, "stripe_customer_id"):
-                if profile.stripe_customer_id != customer_id:
-                    profile.stripe_customer_id = customer_id
-                    profile.save(update_fields=["stripe_customer_id"])
+def _pmb_current_period_end(subscription):
+    """
+    Support both older Stripe shapes (top-level current_period_end)
+    and newer shapes where billing periods live on subscription items.
+    For mixed/proration cases, keep the latest item end date.
+    """
+    try:
+        top_level = subscription.get("current_period_end")
+        if top_level:
+            return utc_from_ts(top_level)
+    except Exception:
+        pass
 
-            plan = SubscriptionPlan.objects.filter(code=plan_code).first()
-            if not plan:
-                logger.warning("Webhook: plan not found in DB: %s", plan_code)
-                return HttpResponse(status=200)
+    try:
+        items = ((subscription.get("items") or {}).get("data")) or []
+        ends = []
 
-            new_status = _map_stripe_status(stripe_sub.get("status"))
-            cancel_at_period_end = bool(stripe_sub.get("cancel_at_period_end", False))
-            cancel_at = _utc_from_ts(stripe_sub.get("cancel_at"))
-            canceled_at = _utc_from_ts(stripe_sub.get("canceled_at"))
-            current_period_end = _utc_from_ts(stripe_sub.get("current_period_end"))
-
-            existing = Subscription.objects.filter(
-                profile=profile,
-                stripe_subscription_id=stripe_sub_id,
-            ).first()
-            prev_status = existing.status if existing else None
-
-            sub_obj, _ = Subscription.objects.update_or_create(
-                profile=profile,
-                stripe_subscription_id=stripe_sub_id,
-                defaults={
-                    "plan": plan,
-                    "status": new_status,
-                    "stripe_customer_id": customer_id or "",
-                    "current_period_end": current_period_end,
-                    "cancel_at_period_end": cancel_at_period_end,
-                    "cancel_at": cancel_at,
-                    "canceled_at": canceled_at,
-                },
-            )
+        for it in items:
+            ts = it.get("current_period_end")
+            dt_value = utc_from_ts(ts)
+            if dt_value:
+                ends.append(dt_value)
 
-            # Cancel local trial record if paid activated
-            if plan_code != "trial":
-                Subscription.objects.filter(
-                    profile=profile,
-                    plan__code="trial",
-                    status=Subscription.STATUS_TRIALING,
-                    stripe_subscription_id="",
-                ).update(
-                    status=Subscription.STATUS_CANCELED,
-                    canceled_at=datetime.datetime.now(tz=datetime.timezone.utc),
-                    cancel_at=None,
-                    cancel_at_period_end=False,
-                )
-
-            # Send "active" email only on transition to ACTIVE
-            if prev_status != Subscription.STATUS_ACTIVE and sub_obj.status == Subscription.STATUS_ACTIVE:
-                to_email = _profile_email(profile)
-                if to_email:
-                    ctx = _base_email_ctx(profile, plan.name)
-                    _send_email(
-                        "emails/subscription_confirmed.html",
-                        "emails/subscription_confirmed.txt",
-                        f"Your MintKit {plan.name} subscription is active ✅",
-                        to_email,
-                        ctx,
-                    )
-
-               # ------------------------------------------------------------
-        # 2) Subscription updated (cancel scheduled/resumed/etc)
-        # ------------------------------------------------------------
-        elif event_type == "customer.subscription.updated":
-            stripe_sub = obj
-
-            profile = _find_profile_for_subscription(stripe_sub)
-            if not profile:
-                return HttpResponse(status=200)
+        if ends:
+            return max(ends)
+    except Exception:
+        pass
+
+    return None
+
+
+def _pmb_infer_plan(subscription):
+    """
+    Return 'basic'/'pro'/'supporter' if we can match by price id, else ''.
+    Prefer higher tiers if multiple items exist during proration transitions.
+    """
+    tiers = set()
 
-            sub_id = stripe_sub.get("id")
-            existing = Subscription.objects.filter(profile=profile, stripe_subscription_id=sub_id).first()
+    try:
+        items = ((subscription.get("items") or {}).get("data")) or []
+        for it in items:
+            tier = _PMB_PRICE_TIERS.get((((it.get("price") or {}).get("id")) or "").strip())
+            if tier:
+                tiers.add(tier)
+    except Exception:
+        pass
 
-            stripe_status = (stripe_sub.get("status") or "").strip().lower()
-            new_status = _map_stripe_status(stripe_status)
+    # Priority: supporter > pro > basic
+    for tier in _PMB_TIER_PRIORITY:
+        if tier in tiers:
+            return tier
 
-            cancel_at_period_end = bool(stripe_sub.get("cancel_at_period_end", False))
-            cancel_at = _utc_from_ts(stripe_sub.get("cancel_at"))
-            canceled_at = _utc_from_ts(stripe_sub.get("canceled_at"))
-            current_period_end = _utc_from_ts(stripe_sub.get("current_period_end"))
-            customer_id = stripe_sub.get("customer")
+    return ""
 
-            md = stripe_sub.get("metadata") or {}
-            plan_code = (md.get("plan_code") or "basic").strip().lower()
-            plan = SubscriptionPlan.objects.filter(code=plan_code).first()
 
-            # If metadata is missing, keep previous plan if available
-            if not plan and existing:
-                plan = existing.plan
-            if not plan:
-                logger.warning("Webhook: cannot resolve plan for sub=%s (no metadata and no local plan).", sub_id)
-                return HttpResponse(status=200)
+def _pmb_upsert(subscription, principal_id=None, plan_code=None):
+    """Upsert the PmbSubscription for a Stripe subscription, keyed by Internet Identity principal."""
+    if not subscription:
+        return
 
-            prev_status = existing.status if existing else None
-            prev_cancel_flag = existing.cancel_at_period_end if existing else False
-            prev_cancel_at = existing.cancel_at if existing else None
-
-            sub_obj, _ = Subscription.objects.update_or_create(
-                profile=profile,
-                stripe_subscription_id=sub_id,
-                defaults={
-                    "plan": plan,
-                    "status": new_status,
-                    "stripe_customer_id": customer_id or "",
-                    "current_period_end": current_period_end,
-                    "cancel_at_period_end": cancel_at_period_end,
-                    "cancel_at": cancel_at,
-                    "canceled_at": canceled_at,
-                },
-            )
+    sub_id = (subscription.get("id") or "").strip()
+    customer_id = (subscription.get("customer") or "").strip()
+    status = (subscription.get("status") or "").strip()
+    current_period_end = _pmb_current_period_end(subscription)
+
+    meta = subscription.get("metadata") or {}
+    principal = (principal_id or meta.get("principal_id") or meta.get("principalId") or "").strip()
 
-            # Stripe can represent "scheduled cancellation" in two ways:
-            # - cancel_at_period_end=True (end of billing period)
-            # - cancel_at=<timestamp>     (portal sometimes sets this while leaving cancel_at_period_end False)
-            scheduled_now = bool(cancel_at_period_end or (cancel_at is not None))
-            scheduled_prev = bool(prev_cancel_flag or (prev_cancel_at is not None))
+    # Plan from metadata / session
+    plan_meta = (plan_code or meta.get("plan_code") or meta.get("plan") or "").strip().lower()
 
-            # Use cancel_at if present, otherwise fall back to current_period_end
-            ends_on = cancel_at or current_period_end
+    # Plan from Stripe subscription items (this is what changes on Billing Portal upgrades)
+    plan_price = _pmb_infer_plan(subscription)
 
+    # Prefer price-derived plan when it matches a known tier
+    plan = plan_price if plan_price in ("basic", "pro", "supporter") else plan_meta
+
+    # --- principal fallback (Billing Portal updates may lose metadata) ---
+    if not principal:
+        existing = None
+        if sub_id:
+            existing = PmbSubscription.objects.filter(stripe_subscription_id=sub_id).first()
+        if not existing and customer_id:
+            existing = PmbSubscription.objects.filter(stripe_customer_id=customer_id).first()
+
+        if existing:
+            principal = (existing.principal_id or "").strip()
+        else:
             logger.warning(
-                "CANCEL CHECK: sub=%s scheduled_prev=%s scheduled_now=%s prev_cap_end=%s prev_cancel_at=%s "
-                "cap_end=%s cancel_at=%s new_status=%s stripe_status=%s",
+                "PMB webhook: missing principal_id and no local match (sub=%s customer=%s)",
                 sub_id,
-                scheduled_prev,
-                scheduled_now,
-                prev_cancel_flag,
-                prev_cancel_at,
-                cancel_at_period_end,
-                cancel_at,
-                new_status,
-                stripe_status,
+                customer_id,
             )
+            return
 
-            # Email when user schedules cancellation (either style)
-            if (not scheduled_prev) and scheduled_now and new_status in (
-                Subscription.STATUS_ACTIVE,
-                Subscription.STATUS_TRIALING,
-            ):
-                to_email = _profile_email(profile)
-                if to_email:
-                    logger.warning(
-                        "CANCEL EMAIL PATH HIT: sub=%s to=%s ends_on=%s cap_end=%s cancel_at=%s status=%s",
-                        sub_id,
-                        to_email,
-                        ends_on,
-                        cancel_at_period_end,
-                        cancel_at,
-                        stripe_status,
-                    )
-
-                    ctx = _base_email_ctx(profile, plan.name)
-                    ctx.update(
-                        {
-                            "ends_on": ends_on,
-                            "manage_url": ctx["portal_url"],
-                            "site_url": ctx["site_root"],
-                        }
-                    )
-                    _send_email(
-                        "emails/subscription_cancelled.html",
-                        "emails/subscription_cancelled.txt",
-                        "Your MintKit subscription will end (unless resumed)",
-                        to_email,
-                        ctx,
-                    )
-
-            # Email when cancelled immediately (status becomes canceled)
-            if prev_status != Subscription.STATUS_CANCELED and sub_obj.status == Subscription.STATUS_CANCELED:
-                to_email = _profile_email(profile)
-                if to_email:
-                    ctx = _base_email_ctx(profile, plan.name)
-                    ctx.update(
-                        {
-                            "ends_on": current_period_end,
-                            "manage_url": ctx["portal_url"],
-                            "site_url": ctx["site_root"],
-                        }
-                    )
-                    _send_email(
-                        "emails/subscription_cancelled.html",
-                        "emails/subscription_cancelled.txt",
-                        "Your MintKit subscription has been cancelled",
-                        to_email,
-                        ctx,
-                    )
-
-        # ------------------------------------------------------------
-        # 3) Subscription deleted (ended)
-        # ------------------------------------------------------------
-        elif event_type == "customer.subscription.deleted":
-            stripe_sub = obj
-
-            profile = _find_profile_for_subscription(stripe_sub)
-            if not profile:
-                return HttpResponse(status=200)
+    # If plan still unknown, keep existing tier, else default to free
+    if plan not in ("basic", "pro", "supporter"):
+        prior = PmbSubscription.objects.filter(principal_id=principal).first()
+        plan = prior.tier if prior else "free"
+
+    rec, _ = PmbSubscription.objects.update_or_create(
+        principal_id=principal,
+        defaults={
+            "tier": plan,
+            "status": status,
+            "stripe_customer_id": customer_id,
+            "stripe_subscription_id": sub_id,
+            "current_period_end": current_period_end,
+        },
+    )
 
-            sub_id = stripe_sub.get("id")
-            sub_obj = Subscription.objects.filter(profile=profile, stripe_subscription_id=sub_id).first()
-
-            current_period_end = _utc_from_ts(stripe_sub.get("current_period_end"))
-            canceled_at = _utc_from_ts(stripe_sub.get("canceled_at")) or datetime.datetime.now(tz=datetime.timezone.utc)
-
-            if sub_obj:
-                sub_obj.status = Subscription.STATUS_CANCELED
-                sub_obj.cancel_at_period_end = False
-                sub_obj.cancel_at = None
-                sub_obj.canceled_at = canceled_at
-                sub_obj.save(update_fields=["status", "cancel_at_period_end", "cancel_at", "canceled_at"])
-
-                # Email: always notify on DELETE events (service ended)
-                to_email = _profile_email(profile)
-                if to_email:
-                    plan_name = sub_obj.plan.name if sub_obj.plan else "subscription"
-                    ctx = _base_email_ctx(profile, plan_name)
-                    ctx.update(
-                        {
-                            "ends_on": current_period_end,
-                            "manage_url": ctx["portal_url"],
-                            "site_url": ctx["site_root"],
-                        }
-                    )
-                    _send_email(
-                        "emails/subscription_cancelled.html",
-                        "emails/subscription_cancelled.txt",
-                        "Your MintKit subscription has ended",
-                        to_email,
-                        ctx,
-                    )
+    logger.info(
+        "PMB subscription upserted: principal=%s tier=%s status=%s sub=%s period_end=%s",
+        rec.principal_id,
+        rec.tier,
+        rec.status,
+        rec.stripe_subscription_id,
+        rec.current_period_end,
+    )
 
-    except Exception:
-        # Keep 200 so Stripe won’t spam retries, but log properly
-        logger.exception("Stripe webhook processing failed for event=%s", event_type)
 
-    return HttpResponse(status=200)
-# -------------------------
-# PlanMyBalance Stripe webhook (separate Stripe account/keys)
-# -------------------------
 @csrf_exempt
 @require_POST
 def stripe_webhook_pmb(request):
@@ -435,150 +605,16 @@ def stripe_webhook_pmb(request):
         logger.error("PMB webhook called but PMB_STRIPE_SECRET_KEY is missing.")
         return HttpResponse(status=500)
 
-    old_key = stripe.api_key
-    stripe.api_key = pmb_key
-
-    def _utc_from_ts(ts):
-        if not ts:
-            return None
-        try:
-            import datetime as dt
-            return dt.datetime.fromtimestamp(int(ts), tz=dt.timezone.utc)
-        except Exception:
-            return None
-
-    def _extract_current_period_end(subscription):
-        """
-        Support both older Stripe shapes (top-level current_period_end)
-        and newer shapes where billing periods live on subscription items.
-        For mixed/proration cases, keep the latest item end date.
-        """
-        try:
-            top_level = subscription.get("current_period_end")
-            if top_level:
-                return _utc_from_ts(top_level)
-        except Exception:
-            pass
-
-        try:
-            items = ((subscription.get("items") or {}).get("data")) or []
-            ends = []
-
-            for it in items:
-                ts = it.get("current_period_end")
-                dt_value = _utc_from_ts(ts)
-                if dt_value:
-                    ends.append(dt_value)
-
-            if ends:
-                return max(ends)
-        except Exception:
-            pass
-
-        return None
-
-    def _infer_plan_from_subscription(subscription):
-        """
-        Return 'basic'/'pro'/'supporter' if we can match by price id, else ''.
-        Prefer higher tiers if multiple items exist during proration transitions.
-        """
-        basic_price = (getattr(settings, "PMB_STRIPE_PRICE_BASIC", "") or "").strip()
-        pro_price = (getattr(settings, "PMB_STRIPE_PRICE_PRO", "") or "").strip()
-        supporter_price = (getattr(settings, "PMB_STRIPE_PRICE_SUPPORTER", "") or "").strip()
-
-        price_ids = []
-
-        try:
-            items = ((subscription.get("items") or {}).get("data")) or []
-            for it in items:
-                pid = (((it.get("price") or {}).get("id")) or "").strip()
-                if pid:
-                    price_ids.append(pid)
-        except Exception:
-            pass
-
-        # Priority: supporter > pro > basic
-        if supporter_price and supporter_price in price_ids:
-            return "supporter"
-        if pro_price and pro_price in price_ids:
-            return "pro"
-        if basic_price and basic_price in price_ids:
-            return "basic"
-
-        return ""
-
-    def _upsert_from_subscription(subscription, principal_id=None, plan_code=None):
-        if not subscription:
-            return
-
-        sub_id = (subscription.get("id") or "").strip()
-        customer_id = (subscription.get("customer") or "").strip()
-        status = (subscription.get("status") or "").strip()
-        current_period_end = _extract_current_period_end(subscription)
-
-        meta = subscription.get("metadata") or {}
-        principal = (principal_id or meta.get("principal_id") or meta.get("principalId") or "").strip()
-
-        # Plan from metadata / session
-        plan_meta = (plan_code or meta.get("plan_code") or meta.get("plan") or "").strip().lower()
-
-        # Plan from Stripe subscription items (this is what changes on Billing Portal upgrades)
-        plan_price = _infer_plan_from_subscription(subscription)
-
-        # Prefer price-derived plan when it matches a known tier
-        plan = plan_price if plan_price in ("basic", "pro", "supporter") else plan_meta
-
-        # --- principal fallback (Billing Portal updates may lose metadata) ---
-        if not principal:
-            existing = None
-            if sub_id:
-                existing = PmbSubscription.objects.filter(stripe_subscription_id=sub_id).first()
-            if not existing and customer_id:
-                existing = PmbSubscription.objects.filter(stripe_customer_id=customer_id).first()
-
-            if existing:
-                principal = (existing.principal_id or "").strip()
-            else:
-                logger.warning(
-                    "PMB webhook: missing principal_id and no local match (sub=%s customer=%s)",
-                    sub_id,
-                    customer_id,
-                )
-                return
-
-        # If plan still unknown, keep existing tier, else default to free
-        if plan not in ("basic", "pro", "supporter"):
-            prior = PmbSubscription.objects.filter(principal_id=principal).first()
-            plan = prior.tier if prior else "free"
-
-        rec, _ = PmbSubscription.objects.update_or_create(
-            principal_id=principal,
-            defaults={
-                "tier": plan,
-                "status": status,
-                "stripe_customer_id": customer_id,
-                "stripe_subscription_id": sub_id,
-                "current_period_end": current_period_end,
-            },
-        )
-
-        logger.info(
-            "PMB subscription upserted: principal=%s tier=%s status=%s sub=%s period_end=%s",
-            rec.principal_id,
-            rec.tier,
-            rec.status,
-            rec.stripe_subscription_id,
-            rec.current_period_end,
-        )
-
     try:
-        event = stripe.Webhook.construct_event(
-            payload=payload,
-            sig_header=sig_header,
-            secret=webhook_secret,
-        )
+        # Same local verification as the MintKit webhook; plain dicts are enough below
+        if not _verify_signature(payload, sig_header, webhook_secret):
+            return HttpResponse(status=400)
+        event = json.loads(payload)
 
         event_type = (event.get("type") or "").strip()
+        if event_type not in _PMB_HANDLED_EVENTS:
+            return HttpResponse(status=200)
+
         obj = (event.get("data") or {}).get("object") or {}
 
         logger.info("PMB webhook received: %s", event_type)
@@ -590,32 +626,24 @@ def stripe_webhook_pmb(request):
 
             subscription_id = obj.get("subscription")
             if subscription_id:
-                subscription = stripe.Subscription.retrieve(subscription_id)
-                _upsert_from_subscription(subscription, principal_id=principal_id, plan_code=plan_code)
+                subscription = stripe.Subscription.retrieve(subscription_id, api_key=pmb_key)
+                _pmb_upsert(subscription, principal_id=principal_id, plan_code=plan_code)
             else:
                 logger.warning("PMB checkout.session.completed had no subscription id")
 
-        elif event_type in (
-            "customer.subscription.created",
-            "customer.subscription.updated",
-            "customer.subscription.deleted",
-        ):
-            _upsert_from_subscription(obj)
+        elif event_type in _PMB_SUBSCRIPTION_EVENTS:
+            _pmb_upsert(obj)
 
         elif event_type == "invoice.payment_failed":
             subscription_id = obj.get("subscription")
             if subscription_id:
-                subscription = stripe.Subscription.retrieve(subscription_id)
-                _upsert_from_subscription(subscription)
+                subscription = stripe.Subscription.retrieve(subscription_id, api_key=pmb_key)
+                _pmb_upsert(subscription)
 
         return HttpResponse(status=200)
 
     except ValueError:
         return HttpResponse(status=400)
-    except stripe.error.SignatureVerificationError:
-        return HttpResponse(status=400)
     except Exception as e:
         logger.exception("PMB webhook error: %s", e)
         return HttpResponse(status=500)
-    finally:
-        stripe.api_key = old_key
\ No newline at end of file
@@ -1,26 +1,31 @@
 #!/usr/bin/env python3
 import re
 import sys
+from array import array
+from bisect import bisect_left
 from pathlib import Path
-from collections import defaultdict
+from collections import Counter, defaultdict
 
 COMMENT_RE = re.compile(r"/\*.*?\*/", re.S)
+WS_RE = re.compile(r"\s+")
+# Whitespace around ; : , { } in one pass (same result as stripping around each in turn)
+DECL_PUNCT_RE = re.compile(r"\s*([;:,{}])\s*")
+# What the rule-body scan stops at: a comment start or a brace
+BLOCK_TOKEN_RE = re.compile(r"/\*|[{}]")
+# Comment header style, first marker wins in this order: dash, equals, underscore, else other
+HEADER_STYLE_RE = re.compile(r"(?=.*---)(?P<dash>)|(?=.*===)(?P<equals>)|(?=.*___)(?P<underscore>)|(?P<other>)")
 
 def strip_comments(s: str) -> str:
-    return re.sub(COMMENT_RE, "", s)
+    return COMMENT_RE.sub("", s)
 
 def norm_ws(s: str) -> str:
-    return re.sub(r"\s+", " ", s).strip()
+    return WS_RE.sub(" ", s).strip()
 
 def norm_decls(block: str) -> str:
     # Normalize declarations for comparison (remove comments + whitespace)
     b = strip_comments(block)
     b = b.replace("\r\n", "\n")
-    b = re.sub(r"\s*;\s*", ";", b)
-    b = re.sub(r"\s*:\s*", ":", b)
-    b = re.sub(r"\s*,\s*", ",", b)
-    b = re.sub(r"\s*\{\s*", "{", b)
-    b = re.sub(r"\s*\}\s*", "}", b)
+    b = DECL_PUNCT_RE.sub(r"\1", b)
     return b.strip()
 
 def main(css_path: Path):
@@ -28,18 +33,11 @@ def main(css_path: Path):
     lines = text.splitlines()
 
     # Collect comment header styles
-    header_styles = defaultdict(int)
-    for i, ln in enumerate(lines, start=1):
-        s = ln.strip()
-        if s.startswith("/*") and s.endswith("*/"):
-            if "---" in s:
-                header_styles["dash"] += 1
-            elif "===" in s:
-                header_styles["equals"] += 1
-            elif "___" in s:
-                header_styles["underscore"] += 1
-            else:
-                header_styles["other"] += 1
+    header_styles = Counter(
+        HEADER_STYLE_RE.match(s).lastgroup
+        for s in map(str.strip, lines)
+        if s.startswith("/*") and s.endswith("*/")
+    )
 
     # Very simple brace-based parser to capture top-level rules + @media scoped rules
     occurrences = defaultdict(list)  # (scope, selector) -> [(start_line, end_line, decl_norm)]
@@ -47,20 +45,15 @@ def main(css_path: Path):
     i = 0
     n = len(text)
 
-    # Helper to map char index -> line number
-    char_to_line = []
-    ln = 1
-    for ch in text:
-        char_to_line.append(ln)
-        if ch == "\n":
-            ln += 1
+    # Helper to map char index -> line number (1 + newlines before it);
+    # newline offsets are packed as machine ints, not one Python int each
+    newline_pos = array("q", (m.start() for m in re.finditer("\n", text)))
 
     def line_at(idx: int) -> int:
         if idx < 0:
             return 1
-        if idx >= len(char_to_line):
-            return char_to_line[-1]
-        return char_to_line[idx]
+        idx = min(idx, n - 1)
+        return bisect_left(newline_pos, idx) + 1
 
     idx = 0
     while idx < n:
@@ -83,8 +76,9 @@ def main(css_path: Path):
         # Detect other at-rules that open blocks (@keyframes etc.) and skip them as rules
         if text.startswith("@", idx):
             brace = text.find("{", idx)
-            semi = text.find(";", idx)
-            if semi != -1 and (brace == -1 or semi < brace):
+            # Only a ";" before the "{" matters, so don't scan past it
+            semi = text.find(";", idx, n if brace == -1 else brace)
+            if semi != -1:
                 idx = semi + 1
                 continue
             if brace == -1:
@@ -106,25 +100,38 @@ def main(css_path: Path):
         if brace == -1:
             break
 
-        chunk = text[idx:brace].strip()
-        # If chunk contains '}' before '{', move forward
-        if "}" in chunk:
-            idx += 1
+        # If chunk contains '}' before '{', move forward to the next thing the
+        # checks above act on ('}', a comment or an at-rule) instead of char by char
+        close = text.find("}", idx, brace)
+        if close != -1:
+            stops = [close]
+            for marker in ("/*", "@"):
+                pos = text.find(marker, idx, close)
+                if pos != -1:
+                    stops.append(pos)
+            idx = min(stops)
             continue
 
+        chunk = text[idx:brace].strip()
+
         # Must look like a selector (not empty, not at-rule)
         if chunk and not chunk.startswith("@"):
             # Find matching closing brace for this rule
             depth = 0
             j = brace
             while j < n:
-                if text.startswith("/*", j):
-                    end = text.find("*/", j + 2)
+                m = BLOCK_TOKEN_RE.search(text, j)
+                if m is None:
+                    j = n
+                    break
+                if m.group() == "/*":
+                    end = text.find("*/", m.end())
                     j = n if end == -1 else end + 2
                     continue
+                j = m.start()
                 if text[j] == "{":
                     depth += 1
-                elif text[j] == "}":
+                else:
                     depth -= 1
                     if depth == 0:
                         break
@@ -134,7 +141,8 @@ def main(css_path: Path):
                 break
 
             decl_block = text[brace+1:j]
-            decl_norm = norm_decls(decl_block)
+            # Interned so repeated blocks share one object and exact-duplicate grouping compares by identity
+            decl_norm = sys.intern(norm_decls(decl_block))
 
             start_line = line_at(idx)
             end_line = line_at(j)